@@ -6,11 +6,14 @@ Automatically discovers and loads algorithms from Python files
 import os
 import importlib
 import inspect
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 
-def discover_algorithms() -> Dict[str, Dict[str, Any]]:
+# Discovered algorithms, populated on the first call to discover_algorithms()
+_ALGORITHM_CACHE: Optional[Dict[str, Dict[str, Any]]] = None
+
+def _scan_algorithms() -> Dict[str, Dict[str, Any]]:
     """
-    Discover all algorithms in the algorithms folder
+    Scan the algorithms folder and load every algorithm module
     
     Returns:
         Dict mapping algorithm keys to their metadata and functions
@@ -19,8 +22,9 @@ def discover_algorithms() -> Dict[str, Dict[str, Any]]:
     algorithms_dir = os.path.dirname(__file__)
     
     # Get all Python files in the algorithms directory
-    for filename in os.listdir(algorithms_dir):
-        if filename.endswith('.py') and filename != '__init__.py':
+    for entry in os.scandir(algorithms_dir):
+        filename = entry.name
+        if entry.is_file() and filename.endswith('.py') and filename != '__init__.py':
             algorithm_key = filename[:-3]  # Remove .py extension
             
             try:
@@ -50,6 +54,28 @@ def discover_algorithms() -> Dict[str, Dict[str, Any]]:
     
     return algorithms
 
+def discover_algorithms() -> Dict[str, Dict[str, Any]]:
+    """
+    Discover all algorithms in the algorithms folder
+    
+    The folder is only scanned once; later calls return the cached result.
+    Call invalidate() to force a rescan (e.g. after adding a new algorithm).
+    
+    Returns:
+        Dict mapping algorithm keys to their metadata and functions
+    """
+    global _ALGORITHM_CACHE
+    if _ALGORITHM_CACHE is None:
+        _ALGORITHM_CACHE = _scan_algorithms()
+    return _ALGORITHM_CACHE
+
+def invalidate() -> None:
+    """
+    Clear the algorithm cache so the next lookup rescans the folder
+    """
+    global _ALGORITHM_CACHE
+    _ALGORITHM_CACHE = None
+
 def get_algorithm_list() -> List[Dict[str, str]]:
     """
     Get list of available algorithms for frontend
@@ -83,8 +109,7 @@ def get_algorithm_function(algorithm_key: str):
     Raises:
         KeyError: If algorithm not found
     """
-    algorithms = discover_algorithms()
-    if algorithm_key not in algorithms:
-        raise KeyError(f"Algorithm '{algorithm_key}' not found")
-    
-    return algorithms[algorithm_key]['function']
+    try:
+        return discover_algorithms()[algorithm_key]['function']
+    except KeyError:
+        raise KeyError(f"Algorithm '{algorithm_key}' not found") from None
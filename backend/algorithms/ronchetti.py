@@ -5,15 +5,27 @@ Based on: https://medium.com/@matteoronchetti/https-medium-com-matteoronchetti-p
 """
 
 import io
+import os
 import math
-import random
-import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 import numpy as np
 import cv2
 from PIL import Image, ImageDraw
-from sklearn.cluster import KMeans
 import scipy.spatial.distance
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fast rendering falls back to OpenCV
+    njit = None
+
+try:
+    import cupy as cp
+except ImportError:  # cupy is optional; color probabilities fall back to the CPU
+    cp = None
+
 # Required metadata
 ALGORITHM_NAME = "Ronchetti Original"
 ALGORITHM_DESCRIPTION = "Advanced pointillism with gradient-based stroke direction and intelligent color selection"
@@ -73,9 +85,49 @@ ALGORITHM_PARAMETERS = [
         "label": "Apply Median Blur",
         "default": True,
         "description": "Apply median blur for a more painted look"
+    },
+    {
+        "name": "fast_render",
+        "type": "checkbox",
+        "label": "Fast Rendering",
+        "default": False,
+        "description": "Draw strokes with a compiled kernel (faster, but without anti-aliasing)"
+    },
+    {
+        "name": "max_output_size",
+        "type": "slider",
+        "label": "Max Output Size",
+        "min": 0,
+        "max": 8000,
+        "step": 100,
+        "default": 2000,
+        "description": "Longest side of the output in pixels; larger images are scaled down first for much faster processing (0 = no limit)"
     }
 ]
 
+# Approximate memory budget for the per-batch color probability arrays
+BATCH_MEMORY_BYTES = 32 * 1024 * 1024
+
+# Bytes per stroke per palette color: the float64 cdist result plus about
+# five float32 temporaries kept alive in compute_color_probabilities
+BATCH_BYTES_PER_COLOR = 8 + 5 * 4
+
+# Stroke coverage above which the blurred base image would be fully painted over
+DENSE_COVERAGE = 3.0
+
+# Height of the horizontal image bands used to order strokes and to split
+# the fast renderer's work between threads
+RENDER_BAND_HEIGHT = 64
+
+# Number of K-means palettes kept for repeated uploads of the same image
+PALETTE_CACHE_SIZE = 32
+_palette_cache = OrderedDict()
+_palette_cache_lock = threading.Lock()
+
+# Process id -> whether CUDA can be used there. Checked lazily because CUDA
+# initialized before a fork (e.g. a preloading WSGI server) is unusable in the child.
+_gpu_status = {}
+
 def limit_size(img, max_size):
     """Limit image size while maintaining aspect ratio"""
     if max_size == 0:
@@ -92,13 +144,13 @@ def limit_size(img, max_size):
 
 def regulate(img, hue=0, saturation=0, luminosity=0):
     """Adjust HSV values of an image"""
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV_FULL)
+    h, s, v = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV_FULL))
     if hue < 0:
         hue = 255 + hue
-    hsv[:, :, 0] += hue
-    hsv[:, :, 1] = np.clip(hsv[:, :, 1] + saturation, 0, 255)
-    hsv[:, :, 2] = np.clip(hsv[:, :, 2] + luminosity, 0, 255)
-    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR_FULL)
+    h += hue
+    s = np.clip(s + saturation, 0, 255)
+    v = np.clip(v + luminosity, 0, 255)
+    return cv2.cvtColor(cv2.merge([h, s, v]), cv2.COLOR_HSV2BGR_FULL)
 
 class ColorPalette:
     """Color palette with K-means clustering and extension capabilities"""
@@ -106,21 +158,24 @@ class ColorPalette:
     def __init__(self, colors, base_len=0):
         self.colors = colors
         self.base_len = base_len if base_len > 0 else len(colors)
+        # Float copy of the colors for distance computations
+        self.colors_f32 = np.asarray(colors, dtype=np.float32)
     
     @staticmethod
-    def from_image(img, n, max_img_size=200, n_init=10):
+    def from_image(img, n, max_img_size=200, n_init=4):
         """Create color palette from image using K-means clustering"""
         # Scale down image for faster clustering
         img_scaled = limit_size(img, max_img_size)
         
         # Reshape image for clustering
-        data = img_scaled.reshape(-1, 3)
+        data = img_scaled.reshape(-1, 3).astype(np.float32)
         
-        # Apply K-means clustering
-        clt = KMeans(n_clusters=n, n_init=n_init, random_state=42)
-        clt.fit(data)
+        # Apply K-means clustering (seeded so the same image gives the same palette)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1.0)
+        cv2.setRNGSeed(42)
+        _, _, centers = cv2.kmeans(data, n, None, criteria, n_init, cv2.KMEANS_PP_CENTERS)
         
-        return ColorPalette(clt.cluster_centers_)
+        return ColorPalette(centers)
     
     def extend(self, extensions):
         """Extend palette with additional color variations"""
@@ -142,12 +197,31 @@ class ColorPalette:
     def __getitem__(self, item):
         return self.colors[item]
 
+def cached_palette(image_data, img, n):
+    """Get the K-means palette for an image, reusing the result for identical uploads"""
+    key = (hashlib.sha256(image_data).digest(), img.shape, n)
+    
+    with _palette_cache_lock:
+        palette = _palette_cache.get(key)
+        if palette is not None:
+            _palette_cache.move_to_end(key)
+            return palette
+    
+    palette = ColorPalette.from_image(img, n)
+    
+    with _palette_cache_lock:
+        _palette_cache[key] = palette
+        if len(_palette_cache) > PALETTE_CACHE_SIZE:
+            _palette_cache.popitem(last=False)
+    
+    return palette
+
+@dataclass(slots=True)
 class VectorField:
     """Vector field for gradient-based stroke direction"""
     
-    def __init__(self, fieldx, fieldy):
-        self.fieldx = fieldx
-        self.fieldy = fieldy
+    fieldx: np.ndarray
+    fieldy: np.ndarray
     
     @staticmethod
     def from_gradient(gray):
@@ -162,53 +236,130 @@ class VectorField:
         for _ in range(iterations):
             self.fieldx = cv2.GaussianBlur(self.fieldx, (s, s), 0)
             self.fieldy = cv2.GaussianBlur(self.fieldy, (s, s), 0)
-    
-    def direction(self, i, j):
-        """Get gradient direction at position (i, j)"""
-        return math.atan2(self.fieldy[i, j], self.fieldx[i, j])
-    
-    def magnitude(self, i, j):
-        """Get gradient magnitude at position (i, j)"""
-        return math.hypot(self.fieldx[i, j], self.fieldy[i, j])
+
+def gpu_available():
+    """Check (once per process) whether a CUDA device can be used through CuPy"""
+    pid = os.getpid()
+    if pid not in _gpu_status:
+        try:
+            _gpu_status[pid] = cp is not None and cp.cuda.runtime.getDeviceCount() > 0
+        except Exception:
+            _gpu_status[pid] = False
+    return _gpu_status[pid]
 
 def compute_color_probabilities(pixels, palette, k=9):
     """Compute color selection probabilities based on distance to palette colors"""
-    distances = scipy.spatial.distance.cdist(pixels, palette.colors)
-    maxima = np.amax(distances, axis=1)
+    if gpu_available():
+        try:
+            return cp.asnumpy(_color_probabilities(cp, pixels, palette, k))
+        except Exception as e:
+            # Stop using the GPU in this process and fall back to the CPU
+            print(f"GPU color probabilities failed, using CPU: {str(e)}")
+            _gpu_status[os.getpid()] = False
     
-    # Normalize distances
-    distances = maxima[:, None] - distances
-    summ = np.sum(distances, 1)
-    distances /= summ[:, None]
+    return _color_probabilities(np, pixels, palette, k)
+
+def _color_probabilities(xp, pixels, palette, k):
+    """Cumulative color probabilities computed with xp (numpy or cupy)"""
+    if xp is cp:
+        # |p - c| = sqrt(|p|^2 + |c|^2 - 2 p.c), avoiding an (N, P, 3) temporary
+        gpu_pixels = cp.asarray(pixels, dtype=cp.float32)
+        gpu_colors = cp.asarray(palette.colors_f32)
+        squared = (cp.sum(gpu_pixels ** 2, axis=1)[:, None] + cp.sum(gpu_colors ** 2, axis=1)[None, :]
+                   - 2 * gpu_pixels @ gpu_colors.T)
+        distances = cp.sqrt(cp.maximum(squared, 0))
+    else:
+        distances = scipy.spatial.distance.cdist(np.asarray(pixels, dtype=np.float32), palette.colors_f32)
+        # cdist always returns float64; single precision is plenty for the softmax
+        distances = distances.astype(np.float32)
     
-    # Apply exponential scaling for probability distribution
-    distances = np.exp(k * len(palette) * distances)
-    summ = np.sum(distances, 1)
-    distances /= summ[:, None]
+    # Normalize distances into per-row closeness weights
+    closeness = xp.amax(distances, axis=1, keepdims=True) - distances
+    summ = xp.sum(closeness, axis=1, keepdims=True)
+    closeness /= xp.maximum(summ, np.finfo(np.float32).eps)
     
-    return np.cumsum(distances, axis=1, dtype=np.float32)
+    # Softmax over the scaled closeness, subtracting the row max to avoid overflow
+    logits = k * len(palette) * closeness
+    logits -= xp.amax(logits, axis=1, keepdims=True)
+    probabilities = xp.exp(logits)
+    probabilities /= xp.sum(probabilities, axis=1, keepdims=True)
+    
+    return xp.cumsum(probabilities, axis=1, dtype=xp.float32)
 
 def color_select(probabilities, palette):
-    """Select color based on probability distribution"""
-    r = random.uniform(0, 1)
-    i = bisect.bisect_left(probabilities, r)
-    return palette[i] if i < len(palette) else palette[-1]
+    """Select one color per row of cumulative probabilities"""
+    r = np.random.random(len(probabilities)).astype(np.float32)
+    # Equivalent to a bisect_left of r into each row
+    i = (probabilities < r[:, None]).sum(axis=1)
+    i = np.minimum(i, len(palette) - 1)
+    return palette[i]
+
+def randomized_grid(h, w, scale, band_height=RENDER_BAND_HEIGHT):
+    """Create randomized grid of stroke positions
 
-def randomized_grid(h, w, scale):
-    """Create randomized grid of stroke positions"""
+    Positions are shuffled within horizontal bands of band_height rows and
+    the bands are returned top to bottom, so consecutive strokes write to
+    nearby memory.
+    """
     assert scale > 0
     
     r = scale // 2
-    grid = []
     
-    for i in range(0, h, scale):
-        for j in range(0, w, scale):
-            y = random.randint(-r, r) + i
-            x = random.randint(-r, r) + j
-            grid.append((y % h, x % w))
+    # Regular grid of cell origins, jittered by up to r pixels in each direction
+    Y, X = np.meshgrid(np.arange(0, h, scale), np.arange(0, w, scale), indexing='ij')
+    Y = (Y + np.random.randint(-r, r + 1, Y.shape)) % h
+    X = (X + np.random.randint(-r, r + 1, X.shape)) % w
     
-    random.shuffle(grid)
-    return grid
+    # (N, 2) array of (y, x) positions, random within each band
+    grid = np.stack([Y.ravel(), X.ravel()], axis=1)
+    np.random.shuffle(grid)
+    order = np.argsort(grid[:, 0] // band_height, kind='stable')
+    return grid[order]
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def draw_strokes_fast(result, ys, xs, lengths, stroke_scale, angles, colors, band_height):
+        """Rasterize filled elliptical strokes into result (no anti-aliasing)
+
+        Each thread owns one horizontal band of the image and walks every
+        stroke in order, so overlapping strokes are painted in the same
+        order as the OpenCV path without any write conflicts.
+        """
+        h, w = result.shape[0], result.shape[1]
+        n_bands = (h + band_height - 1) // band_height
+        # Semi-axes are padded by half a pixel so the filled footprint matches
+        # cv2.ellipse instead of only counting pixels whose centers fall inside
+        b2 = (stroke_scale + 0.5) * (stroke_scale + 0.5)
+        
+        for band in prange(n_bands):
+            top = band * band_height
+            bottom = min(top + band_height, h)
+            
+            for i in range(len(ys)):
+                cy = ys[i]
+                cx = xs[i]
+                length = lengths[i]
+                reach = max(length, stroke_scale)
+                if cy + reach < top or cy - reach >= bottom:
+                    continue
+                
+                theta = math.radians(angles[i])
+                cos_t = math.cos(theta)
+                sin_t = math.sin(theta)
+                a2 = (length + 0.5) * (length + 0.5)
+                
+                for y in range(max(top, cy - reach), min(bottom, cy + reach + 1)):
+                    dy = y - cy
+                    for x in range(max(0, cx - reach), min(w, cx + reach + 1)):
+                        dx = x - cx
+                        u = dx * cos_t + dy * sin_t
+                        v = -dx * sin_t + dy * cos_t
+                        if u * u / a2 + v * v / b2 <= 1.0:
+                            result[y, x, 0] = colors[i, 0]
+                            result[y, x, 1] = colors[i, 1]
+                            result[y, x, 2] = colors[i, 2]
+else:
+    draw_strokes_fast = None
 
 def create_pointillism(image_data, **custom_params):
     """
@@ -216,10 +367,12 @@ def create_pointillism(image_data, **custom_params):
     
     Args:
         image_data (bytes): Raw image data from uploaded file
-        **custom_params: Custom parameters defined in ALGORITHM_PARAMETERS
+        **custom_params: Custom parameters defined in ALGORITHM_PARAMETERS,
+                       plus 'return_bgr' to get the raw OpenCV array back
         
     Returns:
         PIL.Image: The processed pointillism image
+                   (numpy.ndarray in BGR order if return_bgr is set)
         
     Raises:
         Exception: If processing fails
@@ -232,6 +385,9 @@ def create_pointillism(image_data, **custom_params):
         grid_scale = custom_params.get('grid_scale', 3)
         color_randomness = custom_params.get('color_randomness', 9)
         use_median_blur = custom_params.get('use_median_blur', True)
+        fast_render = custom_params.get('fast_render', False) and draw_strokes_fast is not None
+        max_output_size = custom_params.get('max_output_size', 2000)
+        return_bgr = custom_params.get('return_bgr', False)
         
         # Open image from bytes and convert to OpenCV format
         pil_image = Image.open(io.BytesIO(image_data))
@@ -240,6 +396,9 @@ def create_pointillism(image_data, **custom_params):
         
         # Convert PIL to OpenCV format (BGR)
         img = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+        
+        # Scale down huge uploads before any processing
+        img = limit_size(img, max_output_size)
         height, width = img.shape[:2]
         
         # Auto-calculate stroke scale if not provided
@@ -254,7 +413,7 @@ def create_pointillism(image_data, **custom_params):
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
         # Create color palette using K-means clustering
-        palette = ColorPalette.from_image(img, palette_size)
+        palette = cached_palette(image_data, img, palette_size)
         
         # Extend palette with additional color variations
         palette = palette.extend([(0, 50, 0), (15, 30, 0), (-15, 30, 0)])
@@ -263,40 +422,64 @@ def create_pointillism(image_data, **custom_params):
         gradient = VectorField.from_gradient(gray)
         gradient.smooth(gradient_smoothing)
         
-        # Create base image (optionally with median blur for painted look)
-        if use_median_blur:
+        # Precompute stroke angle and length for every pixel from the gradient
+        grad_angle = np.degrees(np.arctan2(gradient.fieldy, gradient.fieldx)) + 90
+        grad_len = np.round(stroke_scale + stroke_scale * np.sqrt(np.hypot(gradient.fieldx, gradient.fieldy))).astype(np.int32)
+        
+        # Create randomized grid of stroke positions
+        grid = randomized_grid(height, width, scale=grid_scale)
+        
+        # Rough ratio of total stroke area to image area
+        coverage = stroke_scale * stroke_scale * len(grid) / (height * width)
+        
+        # Create base image (optionally with median blur for painted look);
+        # skip the blur when the strokes will paint over almost all of it
+        if use_median_blur and coverage > DENSE_COVERAGE:
+            result = np.empty_like(img)
+            result[:] = np.mean(palette.colors, axis=0).astype(np.uint8)
+        elif use_median_blur:
             result = cv2.medianBlur(img, 11)
         else:
             result = img.copy()
         
-        # Create randomized grid of stroke positions
-        grid = randomized_grid(height, width, scale=grid_scale)
+        # Process strokes in batches sized so the probability arrays stay around 32MB
+        batch_size = max(10000, min(len(grid), BATCH_MEMORY_BYTES // (BATCH_BYTES_PER_COLOR * len(palette))))
         
-        # Process strokes in batches for memory efficiency
-        batch_size = 10000
+        # Separate color planes so per-batch gathers read contiguous memory
+        img_b, img_g, img_r = cv2.split(img)
         
         for h in range(0, len(grid), batch_size):
             batch_end = min(h + batch_size, len(grid))
             batch_grid = grid[h:batch_end]
+            ys = batch_grid[:, 0]
+            xs = batch_grid[:, 1]
             
             # Get pixel colors at grid positions
-            pixels = np.array([img[y, x] for y, x in batch_grid])
+            pixels = np.column_stack([img_b[ys, xs], img_g[ys, xs], img_r[ys, xs]]).astype(np.float32)
+            
+            # Get stroke angles and lengths at grid positions
+            angles = grad_angle[ys, xs]
+            lengths = grad_len[ys, xs]
             
             # Compute color probabilities for this batch
             color_probabilities = compute_color_probabilities(pixels, palette, k=color_randomness)
             
+            # Select stroke colors based on probability
+            colors = color_select(color_probabilities, palette).astype(np.uint8)
+            
             # Draw strokes for this batch
-            for i, (y, x) in enumerate(batch_grid):
-                # Select color based on probability
-                color = color_select(color_probabilities[i], palette)
-                color_tuple = (int(color[0]), int(color[1]), int(color[2]))
-                
-                # Calculate stroke angle and length based on gradient
-                angle = math.degrees(gradient.direction(y, x)) + 90
-                length = int(round(stroke_scale + stroke_scale * math.sqrt(gradient.magnitude(y, x))))
-                
+            if fast_render:
+                draw_strokes_fast(result, ys, xs, lengths, stroke_scale, angles, colors, RENDER_BAND_HEIGHT)
+                continue
+            
+            # Convert stroke data to Python lists once rather than per stroke
+            strokes = zip(xs.tolist(), ys.tolist(), lengths.tolist(), angles.tolist(), colors.tolist())
+            for x, y, length, angle, color in strokes:
                 # Draw elliptical brush stroke
-                cv2.ellipse(result, (x, y), (length, stroke_scale), angle, 0, 360, color_tuple, -1, cv2.LINE_AA)
+                cv2.ellipse(result, (x, y), (length, stroke_scale), angle, 0, 360, color, -1, cv2.LINE_AA)
+        
+        if return_bgr:
+            return result
         
         # Convert back to PIL Image (RGB)
         result_rgb = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
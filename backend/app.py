@@ -1,18 +1,23 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import io
-from algorithms import discover_algorithms, get_algorithm_function
+import numpy as np
+import cv2
+from algorithms import discover_algorithms, get_algorithm_function, get_algorithm_list
 
 app = Flask(__name__)
 CORS(app)
 
+# Discover algorithms at import so the cache is warm before the first request
+# (and shared with forked workers when the server preloads the app)
+get_algorithm_list()
+
 @app.route('/api/algorithms', methods=['GET'])
 def get_algorithms():
     """
     Get list of available algorithms
     """
     try:
-        from algorithms import get_algorithm_list
         algorithms = get_algorithm_list()
         return jsonify({
             'success': True,
@@ -56,6 +61,11 @@ def process_image():
         custom_params = {}
         for key, value in request.form.items():
             if key not in ['algorithm', 'image']:
+                # Checkbox values arrive as 'true'/'false'
+                if value in ('true', 'false'):
+                    custom_params[key] = value == 'true'
+                    continue
+                
                 # Try to convert to appropriate type
                 try:
                     # Check if it's a number
@@ -67,16 +77,26 @@ def process_image():
                     # Keep as string
                     custom_params[key] = value
         
+        # Algorithms that support it return a raw BGR array instead of a PIL image
+        custom_params['return_bgr'] = True
+        
         # Process image using selected algorithm
         result_image = algorithm_func(image_data, **custom_params)
         
-        # Convert to base64 for preview
-        img_io = io.BytesIO()
-        result_image.save(img_io, format='PNG')
-        img_io.seek(0)
+        # Encode as PNG (OpenCV encodes BGR arrays directly and is faster than PIL)
+        if isinstance(result_image, np.ndarray):
+            ok, png_buffer = cv2.imencode('.png', result_image, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+            if not ok:
+                raise Exception('Failed to encode result image')
+            png_data = png_buffer.tobytes()
+        else:
+            img_io = io.BytesIO()
+            result_image.save(img_io, format='PNG')
+            png_data = img_io.getvalue()
         
+        # Convert to base64 for preview
         import base64
-        img_base64 = base64.b64encode(img_io.getvalue()).decode('utf-8')
+        img_base64 = base64.b64encode(png_data).decode('utf-8')
         
         return jsonify({
             'success': True,
@@ -0,0 +1,33 @@
+"""
+Gunicorn configuration for the Pointillism Generator backend
+Usage: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Image processing is CPU-heavy and OpenCV/Numba already use several threads
+# per request, so run fewer workers than cores and share the cores between them
+workers = int(os.environ.get('GUNICORN_WORKERS', max(1, multiprocessing.cpu_count() // 2)))
+threads_per_worker = max(1, multiprocessing.cpu_count() // workers)
+
+# Load the app (and discover algorithms) once in the parent process so
+# every forked worker shares the warm algorithm cache. Plugins must not
+# initialize CUDA at import; the Ronchetti GPU check runs lazily per process.
+preload_app = True
+
+# Large images can take a while to process
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+def post_fork(server, worker):
+    """Limit OpenCV and Numba threading in each worker"""
+    import cv2
+    cv2.setNumThreads(threads_per_worker)
+    
+    try:
+        import numba
+        numba.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass